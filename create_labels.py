@@ -2,10 +2,12 @@ import os
 import xmltodict
 import json
 from collections import OrderedDict
+import numpy as np
 
 
 XML_DIR = "VOC2012/Annotations"
 JSON_OUT_DIR = "VOC2012/Labels"
+LABEL_CACHE_DIR = "VOC2012/LabelCache"
 
 def parse_xml_file(filename, xml_dir=XML_DIR):
     """
@@ -83,5 +85,53 @@ def write_json_object_detection_labels(xml_dir=XML_DIR, json_out_dir=JSON_OUT_DI
         with open(os.path.join(json_out_dir, json_filename), 'w') as f:
             json.dump(label, f)
 
+def build_label_cache(xml_dir=XML_DIR, out_dir=LABEL_CACHE_DIR):
+    """
+    Loads all the XML files in a directory and stores their labels as arrays (one
+    .npy file per array, so they can be memory-mapped) so that they don't have to be
+    parsed every epoch.
+
+    The directory contains the following arrays, where the objects of image i are
+    the ones in the range offsets[i]:offsets[i+1]:
+    - names: (m,) image file names without the extension
+    - img_wh: (m, 2) image widths and heights
+    - offsets: (m + 1,) start index of the objects of each image
+    - bndboxes: (n, 4) object bounding boxes as (xmin, xmax, ymin, ymax)
+    - class_indices: (n,) object class indices
+    """
+
+    # imported here so that converting the XML files doesn't import TensorFlow
+    from data_processing import CLASS_NAME_TO_INDEX
+
+    # create the output directory if it doesn't exist
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    names = []
+    img_wh = []
+    offsets = [0]
+    bndboxes = []
+    class_indices = []
+
+    for filename in sorted(os.listdir(xml_dir)):
+        # parse the XML annotation file
+        content = parse_xml_file(filename, xml_dir=xml_dir)
+        label = create_object_detection_label(content)
+
+        # add the label to the arrays
+        names.append(filename.split('.')[0])
+        img_wh.append((label['image-size']['width'], label['image-size']['height']))
+        for obj in label['objects']:
+            bndboxes.append(obj['bndbox'])
+            class_indices.append(CLASS_NAME_TO_INDEX[obj['name']])
+        offsets.append(len(bndboxes))
+
+    np.save(os.path.join(out_dir, 'names.npy'), np.array(names))
+    np.save(os.path.join(out_dir, 'img_wh.npy'), np.array(img_wh, dtype=np.int32))
+    np.save(os.path.join(out_dir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(out_dir, 'bndboxes.npy'), np.array(bndboxes, dtype=np.int32).reshape(-1, 4))
+    np.save(os.path.join(out_dir, 'class_indices.npy'), np.array(class_indices, dtype=np.int32))
+
 if __name__ == "__main__":
-    write_json_object_detection_labels()
\ No newline at end of file
+    write_json_object_detection_labels()
+    build_label_cache()
\ No newline at end of file
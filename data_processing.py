@@ -4,6 +4,8 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 import numpy as np
 import cv2
+from numba import njit
+import tensorflow as tf
 import tensorflow.keras.backend as K
 
 
@@ -16,14 +18,54 @@ CLASS_NAME_TO_INDEX = {
 }
 INDEX_TO_CLASS_NAME = list(CLASS_NAME_TO_INDEX.keys())
 
-def preprocess_image(image, newsize=IMAGE_SHAPE[:2]):
+def preprocess_image(image, newsize=IMAGE_SHAPE[:2], out=None):
     """
     Resizes and normalizes the image
+
+    If out is given, the result is written to it instead of a newly allocated array.
+    It should be a float32 array with the shape of the resized image so that a
+    caller can reuse one buffer for many images, otherwise a ValueError is raised.
+
+    The returned array is always C-contiguous (channels last) so that TensorFlow
+    doesn't have to copy it to feed it to the model.
     """
 
     image = cv2.resize(image, newsize)
-    image = image / 255.
-    return image
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    elif out.shape != image.shape or out.dtype != np.float32:
+        raise ValueError(f'out should be a float32 array of shape {image.shape}, '
+                         f'got a {out.dtype} array of shape {out.shape}')
+
+    # scale straight into the float32 buffer without a float64 intermediate
+    np.multiply(image, np.float32(1. / 255.), out=out, dtype=np.float32)
+    return np.ascontiguousarray(out, dtype=np.float32)
+
+def preprocess_image_batch(images, size=IMAGE_SHAPE[:2]):
+    """
+    Resizes and normalizes a batch of images with TensorFlow ops, so that it can be
+    part of a model (see yolo.ImagePreprocessing) and run on the model's device.
+
+    - images is an (m, height, width, depth) uint8 tensor
+    - size is the new (height, width) of the images
+
+    Returns an (m, size[0], size[1], depth) float32 tensor. The images are only
+    resized if their size is different from size. When the static size is unknown
+    (a model input of any size), this is checked on the actual size of the batch.
+    """
+
+    images = tf.cast(images, tf.float32)
+    if None in images.shape[1:3]:
+        # crop_or_pad() is a no-op on images of the right size, it's used instead of
+        # returning the images as they are so that both branches have the same static
+        # shape, which XLA needs
+        same_size = tf.reduce_all(tf.equal(tf.shape(images)[1:3], size))
+        images = tf.cond(same_size,
+                         lambda: tf.image.resize_with_crop_or_pad(images, size[0], size[1]),
+                         lambda: tf.image.resize(images, size))
+    elif tuple(images.shape[1:3]) != tuple(size):
+        images = tf.image.resize(images, size)
+    return images * (1. / 255.)
 
 def bndbox_to_coords(bndbox, img_width, img_height, s):
     """
@@ -35,9 +77,13 @@ def bndbox_to_coords(bndbox, img_width, img_height, s):
             is the bottom right.
     - w, h: the size of the bounding box in grid units.
     - cell_x, cell_y: coordinates of the cell associated with the bounding box
+
+    bndbox can also be an (n, 4) array of bounding boxes, in which case each of the
+    returned values is an array of shape (n,).
     """
 
-    xmin, xmax, ymin, ymax = bndbox
+    bndbox = np.asarray(bndbox)
+    xmin, xmax, ymin, ymax = bndbox[..., 0], bndbox[..., 1], bndbox[..., 2], bndbox[..., 3]
 
     # absolute position in grid units
     x = (xmin + xmax) / 2 / img_width * s
@@ -48,7 +94,7 @@ def bndbox_to_coords(bndbox, img_width, img_height, s):
     h = (ymax - ymin) / img_height  # * s
 
     # position relative to cell
-    cell_x, cell_y = int(x), int(y)
+    cell_x, cell_y = x.astype(int), y.astype(int)
     x, y = (x - cell_x), (y - cell_y)
 
     return x, y, w, h, cell_x, cell_y
@@ -58,6 +104,9 @@ def coords_to_bndbox(x, y, w, h, cell_x, cell_y, img_width, img_height, s):
     Given bounding box data in the format specified by bndbox_to_coords() as well as
     the image dimensions and the grid size (s), this function returns the bounding
     box in pixel coordinates as (xmin, xmax, ymin, ymax).
+
+    The arguments can also be arrays of the same shape, in which case each of
+    xmin, xmax, ymin and ymax is an integer array of that shape.
     """
 
     x = (x + cell_x) * img_width / s
@@ -65,13 +114,68 @@ def coords_to_bndbox(x, y, w, h, cell_x, cell_y, img_width, img_height, s):
     w = w * img_width   # / s
     h = h * img_height  # / s
 
-    xmin = round(x - w / 2)
-    xmax = round(x + w / 2)
-    ymin = round(y - h / 2)
-    ymax = round(y + h / 2)
+    xmin = np.round(x - w / 2).astype(int)
+    xmax = np.round(x + w / 2).astype(int)
+    ymin = np.round(y - h / 2).astype(int)
+    ymax = np.round(y + h / 2).astype(int)
 
     return xmin, xmax, ymin, ymax
 
+@njit(cache=True, nogil=True)
+def _fill_truth_tensor(x, y, w, h, cell_x, cell_y, class_indices, s, b, c):
+    """
+    Compiled core of get_truth_from_arrays().
+
+    Takes (n,) arrays of object data in the format returned by bndbox_to_coords()
+    and (n,) class indices.
+    """
+
+    truth_tensor = np.zeros((s, s, b * 5 + c), dtype=np.float32)
+
+    for i in range(x.shape[0]):
+        # only the first object in each cell is added to the tensor
+        if truth_tensor[cell_y[i], cell_x[i], c] == 0:
+            truth_tensor[cell_y[i], cell_x[i], class_indices[i]] = 1   # class probabilities
+            truth_tensor[cell_y[i], cell_x[i], c] = 1 # box confidence score
+            truth_tensor[cell_y[i], cell_x[i], c+b] = x[i]  # box coordinates
+            truth_tensor[cell_y[i], cell_x[i], c+b+1] = y[i]
+            truth_tensor[cell_y[i], cell_x[i], c+b+2] = w[i]
+            truth_tensor[cell_y[i], cell_x[i], c+b+3] = h[i]
+
+    return truth_tensor
+
+@njit(cache=True, nogil=True)
+def _extract_objects(tensor, threshold, b, c):
+    """
+    Compiled core of get_label_from_tensor().
+
+    Returns the cell_x, cell_y, (x, y, w, h) coordinates and class index of each
+    cell whose first box has a confidence score of at least threshold.
+    """
+
+    s = tensor.shape[0]
+    n = 0
+    for cell_y in range(s):
+        for cell_x in range(s):
+            if tensor[cell_y, cell_x, c] >= threshold:
+                n += 1
+
+    cells_x = np.empty(n, dtype=np.int32)
+    cells_y = np.empty(n, dtype=np.int32)
+    coords = np.empty((n, 4), dtype=tensor.dtype)
+    class_indices = np.empty(n, dtype=np.int32)
+
+    i = 0
+    for cell_y in range(s):
+        for cell_x in range(s):
+            if tensor[cell_y, cell_x, c] >= threshold:
+                cells_x[i], cells_y[i] = cell_x, cell_y
+                coords[i] = tensor[cell_y, cell_x, c+b:c+b+4]
+                class_indices[i] = np.argmax(tensor[cell_y, cell_x, :c])
+                i += 1
+
+    return cells_x, cells_y, coords, class_indices
+
 def get_truth_from_label(label, s=7, b=3, c=20):
     """
     Creates a truth label tensor using a label dictionary
@@ -92,36 +196,83 @@ def get_truth_from_label(label, s=7, b=3, c=20):
 
     img_width, img_height = label['image-size']['width'], label['image-size']['height']
 
-    truth_shape = (s, s, b * 5 + c)
-    truth_tensor = np.zeros(truth_shape, dtype=np.float32)
+    # get object data as arrays: (n, 4) bounding boxes and (n,) class indices
+    objects = label['objects']
+    bndboxes = np.array([obj['bndbox'] for obj in objects], dtype=np.float64).reshape(-1, 4)
+    class_indices = np.fromiter((CLASS_NAME_TO_INDEX[obj['name']] for obj in objects),
+                                dtype=np.int32, count=len(objects))
+
+    truth_tensor = get_truth_from_arrays(bndboxes, class_indices, img_width, img_height, s, b, c)
+    return truth_tensor
+
+def get_truth_from_arrays(bndboxes, class_indices, img_width, img_height, s=7, b=3, c=20):
+    """
+    Creates a truth label tensor in the format specified in get_truth_from_label()
+    from arrays of object data, such as the ones stored by create_labels.build_label_cache().
+
+    - bndboxes is an (n, 4) array of bounding boxes in pixel coordinates (xmin, xmax, ymin, ymax)
+    - class_indices is an (n,) array of class indices
+    - img_width, img_height are the image dimensions
+
+    Boxes whose center is on (or outside) the right or bottom edge of the image are
+    assigned to the nearest cell, like darknet does. Raises a ValueError if a class
+    index is out of range.
+    """
+
+    bndboxes = np.asarray(bndboxes).reshape(-1, 4)
+    class_indices = np.asarray(class_indices)
+    if class_indices.shape != (len(bndboxes),):
+        raise ValueError(f'Expected {len(bndboxes)} class indices, got an array of shape {class_indices.shape}')
+    if np.any((class_indices < 0) | (class_indices >= c)):
+        raise ValueError(f'Class indices should be in the range [0, {c})')
 
-    for object in label['objects']:
-        # get object data
-        class_index = CLASS_NAME_TO_INDEX[object['name']]
-        x, y, w, h, cell_x, cell_y = bndbox_to_coords(object['bndbox'], img_width, img_height, s)
+    x, y, w, h, cell_x, cell_y = bndbox_to_coords(bndboxes, img_width, img_height, s)
 
-        # add the data to the tensor
-        if truth_tensor[cell_y, cell_x, c] == 0:
-            truth_tensor[cell_y, cell_x, class_index] = 1   # class probabilities
-            truth_tensor[cell_y, cell_x, c] = 1 # box confidence score
-            truth_tensor[cell_y, cell_x, c+b:c+b+4] = x, y, w, h  # box coordinates
-        
+    # keep the cells inside the grid, the compiled kernel doesn't check bounds
+    clipped_cell_x, clipped_cell_y = np.clip(cell_x, 0, s - 1), np.clip(cell_y, 0, s - 1)
+    x, y = x + (cell_x - clipped_cell_x), y + (cell_y - clipped_cell_y)
+
+    truth_tensor = _fill_truth_tensor(x, y, w, h, clipped_cell_x, clipped_cell_y, class_indices, s, b, c)
     return truth_tensor
 
-def get_label_from_tensor(tensor, s=7, b=3, c=20):
+def get_label_from_tensor(tensor, img_width, img_height, img_depth=3, s=7, b=3, c=20, threshold=1.):
     """
     Converts a tensor (either a truth tensor or a predicted tensor) to a label dictionary.
 
     - tensor is an (s, s, (b * 5 + c)) shaped tensor with the format specified in get_truth_from_label()
+    - img_width, img_height and img_depth are the dimensions of the labelled image
     - s is the size of the grid (there will be s*s cells)
     - b is the number of bounding boxes for each cell
     - c is the number of possible classes
+    - threshold is the minimum confidence score of the first box for a cell to contain an object
 
     - Returns a label dictionary in the format specified in create_labels.create_object_detection_label()
+      except that the 'difficult' property is omitted.
     """
 
-    # TODO
-    pass
+    if tensor.shape != (s, s, b * 5 + c):
+        raise ValueError(f'Expected a tensor of shape {(s, s, b * 5 + c)}, got {tensor.shape}')
+
+    cell_x, cell_y, coords, class_indices = _extract_objects(tensor, threshold, b, c)
+
+    # get the bounding boxes
+    x, y, w, h = coords.T
+    xmin, xmax, ymin, ymax = coords_to_bndbox(x, y, w, h, cell_x, cell_y, img_width, img_height, s)
+
+    objects = []
+    for i, class_index in enumerate(class_indices):
+        obj = {
+            'name': INDEX_TO_CLASS_NAME[class_index],
+            'bndbox': [int(xmin[i]), int(xmax[i]), int(ymin[i]), int(ymax[i])]
+        }
+        objects.append(obj)
+
+    label = {
+        "image-size": {"depth": img_depth, "width": img_width, "height": img_height},
+        "objects": objects
+    }
+
+    return label
 
 def filter_predictions(class_probs, box_confs, box_coords, threshold=0.0001):
     """
@@ -357,8 +508,8 @@ if __name__ == '__main__':
     #     print(label)
 
     #     img = preprocess_image(img)
-    #     label_tensor = preprocess_label(label)
-    #     resized_label = tensor_to_label(label_tensor, img.shape[1], img.shape[0], img.shape[2])
+    #     label_tensor = get_truth_from_label(label)
+    #     resized_label = get_label_from_tensor(label_tensor, img.shape[1], img.shape[0], img.shape[2])
 
     #     img = label_image(img, resized_label)
     #     plt.imshow(img)
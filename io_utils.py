@@ -10,12 +10,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 import tensorflow as tf
-from data_processing import preprocess_image, get_truth_from_label
+from data_processing import preprocess_image, get_truth_from_label, get_truth_from_arrays, IMAGE_SHAPE
 
 
 IMAGES_ZIP_PATH = "VOC2012/JPEG.zip"
 IMAGES_DIR = "VOC2012/JPEG"
 LABELS_DIR = "VOC2012/Labels"
+LABEL_CACHE_DIR = "VOC2012/LabelCache"
 
 def get_filename(filepath):
     """
@@ -98,13 +99,69 @@ def label_image(image, label):
     return image
 
 
+class LabelCache:
+    """
+    Truth labels stored as arrays by create_labels.build_label_cache().
+
+    The arrays are memory-mapped, so opening the cache is cheap and worker
+    processes share the same pages. Indexing the cache with an image index
+    returns the image's truth label tensor, without any dictionaries or parsing.
+    """
+
+    def __init__(self, cache_dir=LABEL_CACHE_DIR):
+        def load(name):
+            return np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+
+        self.names = load('names')
+        self.img_wh = load('img_wh')
+        self.offsets = load('offsets')
+        self.bndboxes = load('bndboxes')
+        self.class_indices = load('class_indices')
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i+1]
+        img_width, img_height = self.img_wh[i]
+
+        truth_tensor = get_truth_from_arrays(self.bndboxes[start:end], self.class_indices[start:end],
+                                             img_width, img_height)
+        return truth_tensor
+
+    def get_truth(self, image_name):
+        """
+        Returns the truth label tensor of an image given its file name without the extension
+        """
+
+        return self[self.index[image_name]]
+
+
 class DataGenerator(tf.keras.utils.Sequence):
-    def __init__(self, image_paths, label_paths, batch_size, from_zip=False, zip_file=None):
+    """
+    Generates batches of preprocessed examples.
+
+    If gpu_preprocess is True, the batches contain the uint8 images for a model
+    created with create_model_from_cfg(..., uint8_input=True), which resizes and
+    normalizes them on its device. The images are only resized on the CPU when the
+    images of a batch have different sizes, so that they can be stacked. The model
+    skips resizing batches that are already IMAGE_SHAPE, so for those batches only
+    the conversion to float32 and the scaling run on the device.
+
+    If label_cache (a LabelCache) is given, the labels are looked up in it by file
+    name instead of being loaded from the label files.
+    """
+
+    def __init__(self, image_paths, label_paths, batch_size, from_zip=False, zip_file=None, gpu_preprocess=False,
+                 label_cache=None):
         self.image_paths = image_paths
         self.label_paths = label_paths
         self.batch_size = batch_size
         self.from_zip = from_zip
         self.zip_file = zip_file
+        self.gpu_preprocess = gpu_preprocess
+        self.label_cache = label_cache
     
     def __len__(self):
         return math.ceil(len(self.image_paths) / self.batch_size)
@@ -113,7 +170,10 @@ class DataGenerator(tf.keras.utils.Sequence):
         batch_image_paths = self.image_paths[idx * self.batch_size:(idx + 1) * self.batch_size]
         batch_label_paths = self.label_paths[idx * self.batch_size:(idx + 1) * self.batch_size]
 
-        batch_x = []
+        if self.gpu_preprocess:
+            batch_x = []
+        else:
+            batch_x = np.empty((len(batch_image_paths),) + IMAGE_SHAPE, dtype=np.float32)
         batch_y = []
 
         for i in range(0, len(batch_image_paths)):
@@ -125,16 +185,26 @@ class DataGenerator(tf.keras.utils.Sequence):
                 image = load_image_from_zip(self.zip_file, image_path)
             else:
                 image = load_image(image_path)
-            label = load_label(label_path)
 
             # preprocess the example
-            x = preprocess_image(image)
-            y = get_truth_from_label(label)
+            if self.gpu_preprocess:
+                batch_x.append(image)
+            else:
+                preprocess_image(image, out=batch_x[i])
+
+            if self.label_cache is not None:
+                y = self.label_cache.get_truth(get_filename(label_path))
+            else:
+                y = get_truth_from_label(load_label(label_path))
 
-            batch_x.append(x)
             batch_y.append(y)
 
-        return np.array(batch_x), np.array(batch_y)
+        if self.gpu_preprocess:
+            if len(set(image.shape for image in batch_x)) > 1:
+                batch_x = [cv2.resize(image, IMAGE_SHAPE[:2]) for image in batch_x]
+            batch_x = np.stack(batch_x)
+
+        return batch_x, np.array(batch_y)
 
 
 if __name__ == "__main__":
@@ -2,21 +2,26 @@ import argparse
 
 import zipfile
 from io_utils import DataGenerator, get_labelpath_from_imagename, get_filename, IMAGES_ZIP_PATH
-from yolo import parse_cfg, create_model_from_cfg, yolo_loss
+from yolo import parse_cfg, create_model_from_cfg, get_optimizer_for_dtype, yolo_loss
 from tensorflow.keras.optimizers import Adam
 
 
 def main():
     argparser = argparse.ArgumentParser('train')
     argparser.add_argument('cfg', metavar='<cfg-file>', help='Model configuration file')
+    argparser.add_argument('--dtype', default='float32', choices=['float32', 'mixed_float16', 'mixed_bfloat16'],
+                           help='Dtype policy of the model\'s layers')
+    argparser.add_argument('--gpu-preprocess', action='store_true',
+                           help='Resize and normalize the images inside the model instead of in the data generator')
 
     # load and parse the model configuration file
     args = argparser.parse_args()
     cfg = parse_cfg(args.cfg)
 
     # create and compile the model
-    model = create_model_from_cfg(cfg)
-    model.compile(optimizer=Adam(learning_rate=0.0001), loss=yolo_loss)
+    model = create_model_from_cfg(cfg, dtype=args.dtype, uint8_input=args.gpu_preprocess)
+    optimizer = get_optimizer_for_dtype(Adam(learning_rate=0.0001), args.dtype)
+    model.compile(optimizer=optimizer, loss=yolo_loss)
 
     # open the images zip file
     with zipfile.ZipFile(IMAGES_ZIP_PATH, 'r') as images_zip:
@@ -25,7 +30,8 @@ def main():
 
         # training data batch generator
         batch_size = 4
-        train_batch_gen = DataGenerator(image_paths, label_paths, batch_size, from_zip=True, zip_file=images_zip)
+        train_batch_gen = DataGenerator(image_paths, label_paths, batch_size, from_zip=True, zip_file=images_zip,
+                                        gpu_preprocess=args.gpu_preprocess)
 
         # train the model
         model.fit(x=train_batch_gen,
@@ -2,25 +2,40 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
 # os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
+import re
 import numpy as np
 import tensorflow as tf
 import tensorflow.keras.backend as K
 
+try:
+    from tensorflow.keras.mixed_precision import Policy, LossScaleOptimizer
+    EXPERIMENTAL_MIXED_PRECISION = False
+except ImportError:
+    # TensorFlow < 2.4 only has the experimental mixed precision API
+    from tensorflow.keras.mixed_precision.experimental import Policy, LossScaleOptimizer
+    EXPERIMENTAL_MIXED_PRECISION = True
+
 from tensorflow.keras.layers import (
     InputLayer,
     Conv2D,
     MaxPooling2D,
     ZeroPadding2D,
-    LocallyConnected2D,
     Dense,
     LeakyReLU,
     Flatten,
+    Permute,
     Reshape,
     BatchNormalization,
     Dropout
 )
 
-from data_processing import keras_iou, keras_yolo_to_image_coords, keras_image_coords_to_minmax, IMAGE_SHAPE
+from data_processing import (
+    keras_iou,
+    keras_yolo_to_image_coords,
+    keras_image_coords_to_minmax,
+    preprocess_image_batch,
+    IMAGE_SHAPE
+)
 
 
 class YOLODetection(tf.keras.layers.Layer):
@@ -81,6 +96,160 @@ class YOLODetection(tf.keras.layers.Layer):
         return outputs
 
 
+class ImagePreprocessing(tf.keras.layers.Layer):
+    """
+    Resizes and normalizes batches of uint8 images inside the model (see
+    data_processing.preprocess_image_batch()) so that it runs on the model's device
+    """
+
+    def __init__(self, height, width, *args, **kwargs):
+        super(ImagePreprocessing, self).__init__(*args, **kwargs)
+        self.height = height
+        self.width = width
+
+    def get_config(self):
+        config = super().get_config().copy()
+        config.update({
+            'height': self.height,
+            'width': self.width
+        })
+        return config
+
+    def call(self, x):
+        return preprocess_image_batch(x, (self.height, self.width))
+
+
+class LocalAsConv(tf.keras.layers.Layer):
+    """
+    Locally connected 2D layer (a convolution whose weights are not shared between
+    output positions) used instead of Keras' slow LocallyConnected2D.
+
+    The input patches are extracted with strided slices (rather than with
+    tf.image.extract_patches(), which TensorFlow Lite doesn't support) and multiplied
+    by the kernel of their output position in a single einsum:
+
+    - kernel has the shape (h_out, w_out, k_size * k_size * c_in, filters) where each
+      patch is flattened in the order (k_size, k_size, c_in)
+    - bias has the shape (h_out, w_out, filters)
+
+    With channels_first, the patches are sliced and concatenated along the NCHW axes
+    so that the input and the outputs are never transposed.
+    """
+
+    def __init__(self, filters, kernel_size, strides=1, padding='valid', data_format='channels_last', use_bias=True,
+                 *args, **kwargs):
+        super(LocalAsConv, self).__init__(*args, **kwargs)
+        self.filters = filters
+        self.kernel_size = kernel_size
+        self.strides = strides
+        self.padding = padding
+        self.data_format = data_format
+        self.use_bias = use_bias
+
+    def get_config(self):
+        config = super().get_config().copy()
+        config.update({
+            'filters': self.filters,
+            'kernel_size': self.kernel_size,
+            'strides': self.strides,
+            'padding': self.padding,
+            'data_format': self.data_format,
+            'use_bias': self.use_bias
+        })
+        return config
+
+    def _get_output_size(self, h_in, w_in):
+        if self.padding == 'same':
+            h_out = -(-h_in // self.strides)
+            w_out = -(-w_in // self.strides)
+        else:
+            h_out = (h_in - self.kernel_size) // self.strides + 1
+            w_out = (w_in - self.kernel_size) // self.strides + 1
+        return h_out, w_out
+
+    def build(self, input_shape):
+        if self.data_format == 'channels_first':
+            _, c_in, h_in, w_in = input_shape
+        else:
+            _, h_in, w_in, c_in = input_shape
+        h_out, w_out = self._get_output_size(h_in, w_in)
+
+        kernel_shape = (h_out, w_out, self.kernel_size * self.kernel_size * c_in, self.filters)
+        self.kernel = self.add_weight('kernel', shape=kernel_shape, initializer='glorot_uniform')
+        if self.use_bias:
+            self.bias = self.add_weight('bias', shape=(h_out, w_out, self.filters), initializer='zeros')
+
+        super(LocalAsConv, self).build(input_shape)
+
+    def compute_output_shape(self, input_shape):
+        if self.data_format == 'channels_first':
+            m, _, h_in, w_in = input_shape
+            return (m, self.filters) + self._get_output_size(h_in, w_in)
+        else:
+            m, h_in, w_in, _ = input_shape
+            return (m,) + self._get_output_size(h_in, w_in) + (self.filters,)
+
+    def call(self, x):
+        k_size, strides = self.kernel_size, self.strides
+        channels_first = self.data_format == 'channels_first'
+        h_axis, w_axis, c_axis = (2, 3, 1) if channels_first else (1, 2, 3)
+        h_in, w_in = x.shape[h_axis], x.shape[w_axis]
+        h_out, w_out = self._get_output_size(h_in, w_in)
+
+        # pad the input the same way as tf.nn.conv2d() does
+        if self.padding == 'same':
+            pad_h = max((h_out - 1) * strides + k_size - h_in, 0)
+            pad_w = max((w_out - 1) * strides + k_size - w_in, 0)
+            paddings = [[0, 0]] * 4
+            paddings[h_axis] = [pad_h // 2, pad_h - pad_h // 2]
+            paddings[w_axis] = [pad_w // 2, pad_w - pad_w // 2]
+            x = tf.pad(x, paddings)
+
+        # (m, h_out, w_out, k_size * k_size * c_in) patches, or (m, k_size * k_size * c_in, h_out, w_out)
+        # for channels_first, so that the input never has to be transposed
+        patches = []
+        for i in range(k_size):
+            for j in range(k_size):
+                patch = [slice(None)] * 4
+                patch[h_axis] = slice(i, i + (h_out - 1) * strides + 1, strides)
+                patch[w_axis] = slice(j, j + (w_out - 1) * strides + 1, strides)
+                patches.append(x[tuple(patch)])
+        patches = tf.concat(patches, axis=c_axis)
+
+        if channels_first:
+            outputs = tf.einsum('nkhw,hwkf->nfhw', patches, self.kernel)
+            if self.use_bias:
+                outputs = outputs + tf.transpose(self.bias, [2, 0, 1])
+        else:
+            outputs = tf.einsum('nhwk,hwkf->nhwf', patches, self.kernel)
+            if self.use_bias:
+                outputs = outputs + self.bias
+
+        return outputs
+
+
+CFG_SECTION_PATTERN = re.compile(r'^\[(.+)\]$')
+CFG_OPTION_PATTERN = re.compile(r'^([^=]+?)\s*=\s*(.*)$')
+CFG_INT_PATTERN = re.compile(r'^[+-]?[0-9]+$')
+
+def parse_cfg_value(value):
+    """
+    Converts a configuration value to an int or a float if possible, otherwise
+    returns the string as it is.
+    """
+
+    if CFG_INT_PATTERN.match(value):
+        return int(value)
+
+    # only try parsing a float if the value looks like one
+    if '.' in value or 'e' in value or 'E' in value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+
+    return value
+
 def parse_cfg(filepath):
     """
     Parses a configuration file into a list of dictionaries where each
@@ -90,7 +259,6 @@ def parse_cfg(filepath):
     cfg = []
 
     with open(filepath, 'r') as f:
-        # current_section = None
         for line in f:
             line = line.strip()
 
@@ -99,48 +267,62 @@ def parse_cfg(filepath):
                 continue
 
             # the start of a new section
-            if line.startswith('['):
-                section_name = line[1:-1]
+            match = CFG_SECTION_PATTERN.match(line)
+            if match:
                 current_section = {}
-                cfg.append((section_name, current_section))
+                cfg.append((match.group(1), current_section))
+                continue
+
+            # an option in the current section, with one or more comma separated values
+            match = CFG_OPTION_PATTERN.match(line)
+            if not match or not cfg:
+                raise ValueError(f'Invalid line in {filepath}: {line!r}')
+            key, values = match.groups()
+            if ',' in values:
+                values = [parse_cfg_value(value.strip()) for value in values.split(',')]
             else:
-                key, values = [s.strip() for s in line.split('=')]
-                values = [s.strip() for s in values.split(',')]
-
-                # parse the value
-                for i, value in enumerate(values):
-                    try:
-                        value = int(value)
-                    except ValueError:
-                        try:
-                            value = float(value)
-                        except:
-                            # string value
-                            pass
-                    values[i] = value
-
-                if len(values) == 1:
-                    values = values[0]
-                
-                current_section[key] = values
+                values = parse_cfg_value(values)
+
+            current_section[key] = values
     
     return cfg
 
-def create_model_from_cfg(cfg):
+def create_model_from_cfg(cfg, data_format='channels_last', dtype='float32', uint8_input=False):
     """
     Creates a tf.keras model using a configuration dictionray
     as returned by parse_cfg().
+
+    data_format is the layout of the feature maps inside the model, either
+    'channels_last' (NHWC) or 'channels_first' (NCHW). The model always takes
+    NHWC images as input; in the channels_first case they are transposed once
+    at the input so that there are no layout transposes around each layer.
+    Note that TensorFlow only supports channels_first convolutions on the GPU.
+
+    dtype is the Keras dtype policy of the layers: 'float32', 'mixed_float16' or
+    'mixed_bfloat16'. The mixed policies compute in 16 bits (which is faster on
+    GPUs with tensor cores, and TPUs for bfloat16) while keeping the variables in
+    float32. The detection layer always computes in float32 so the outputs are
+    float32, the predictions may differ slightly from the float32 model's. To train
+    a 'mixed_float16' model, wrap its optimizer with get_optimizer_for_dtype() so that
+    the loss is scaled and the float16 gradients don't underflow.
+
+    If uint8_input is True, the model takes batches of uint8 images of any size and
+    resizes and normalizes them itself (see ImagePreprocessing), so that this runs
+    on the model's device instead of in the data loader.
     """
 
-    # create the model
-    model = tf.keras.models.Sequential()
+    channel_axis = 1 if data_format == 'channels_first' else -1
+    policy = Policy(dtype)
+
+    # the model's layers in order, connected with the functional API once they're all created
+    layers = []
     block_index = 0
     
     def add_conv_or_local(is_conv, section):
         
-        filters = section['filters']
-        kernel_size = section['size']
-        strides = section['stride']
+        filters = int(section['filters'])
+        kernel_size = int(section['size'])
+        strides = int(section['stride'])
 
         # add padding
         padding = section['pad']
@@ -148,7 +330,15 @@ def create_model_from_cfg(cfg):
             pad = (kernel_size - 1) // 2
         else:
             pad = 0
-        model.add(ZeroPadding2D(pad, name=f'pad_{block_index}'))
+
+        # let the layer pad its input itself when that is equivalent, which saves a pass over the input.
+        # with strides > 1, 'same' padding pads more at the bottom and right than darknet does
+        if strides == 1 and kernel_size % 2 == 1 and pad == (kernel_size - 1) // 2:
+            layer_padding = 'same'
+        else:
+            layer_padding = 'valid'
+            if pad > 0:
+                layers.append(ZeroPadding2D(pad, data_format=data_format, dtype=policy, name=f'pad_{block_index}'))
 
         # check batch norm
         try:
@@ -162,54 +352,106 @@ def create_model_from_cfg(cfg):
             layer_class = Conv2D
             layer_name = f'conv_{block_index}'
         else:
-            layer_class = LocallyConnected2D
+            layer_class = LocalAsConv
             layer_name = f'local_{block_index}'
-        model.add(layer_class(filters, kernel_size, strides, use_bias=use_bias, name=layer_name))
+        layers.append(layer_class(filters, kernel_size, strides, padding=layer_padding, data_format=data_format,
+                              use_bias=use_bias, dtype=policy, name=layer_name))
 
         # add batch norm layer
         if batch_normalize:
-            model.add(BatchNormalization(name=f'batchnorm_{block_index}'))
+            layers.append(BatchNormalization(axis=channel_axis, dtype=policy, name=f'batchnorm_{block_index}'))
 
         # add the activation
         activation = section['activation']
         if activation == 'leaky':
-            model.add(LeakyReLU(alpha=0.1, name=f'leaky_{block_index}'))
+            layers.append(LeakyReLU(alpha=0.1, dtype=policy, name=f'leaky_{block_index}'))
 
     for name, section in cfg:
         if name == 'net':
-            input_shape = (section['height'], section['width'], section['channels'])
-            model.add(InputLayer(input_shape=input_shape, name='input_0'))
+            input_shape = (int(section['height']), int(section['width']), int(section['channels']))
+            if uint8_input:
+                inputs = tf.keras.Input(shape=(None, None, input_shape[2]), dtype='uint8', name='input_0')
+                x = ImagePreprocessing(input_shape[0], input_shape[1], name='preprocess_0')(inputs)
+            else:
+                inputs = tf.keras.Input(shape=input_shape, name='input_0')
+                x = inputs
+            if data_format == 'channels_first':
+                layers.append(Permute((3, 1, 2), dtype=policy, name='transpose_0'))
         elif name == 'convolutional':
             add_conv_or_local(True, section)
         elif name == 'maxpool':
-            pool_size = section['size']
-            strides = section['stride']
-            model.add(MaxPooling2D(pool_size, strides, name=f'maxpool_{block_index}'))
+            pool_size = int(section['size'])
+            strides = int(section['stride'])
+            layers.append(MaxPooling2D(pool_size, strides, data_format=data_format, dtype=policy,
+                                   name=f'maxpool_{block_index}'))
         elif name == 'local':
             add_conv_or_local(False, section)
         elif name == 'dropout':
             rate = section['probability']
-            model.add(Dropout(rate, name=f'dropout_{block_index}'))
+            layers.append(Dropout(rate, dtype=policy, name=f'dropout_{block_index}'))
         elif name == 'connected':
-            units = section['output']
+            units = int(section['output'])
             activation = section['activation']
             
-            model.add(Flatten(name=f'flatten_{block_index}'))
-            model.add(Dense(units, name=f'connected_{block_index}'))
+            layers.append(Flatten(data_format=data_format, dtype=policy, name=f'flatten_{block_index}'))
+            layers.append(Dense(units, dtype=policy, name=f'connected_{block_index}'))
             
             if activation == 'leaky':
-                model.add(LeakyReLU(alpha=0.1, name=f'leaky_{block_index}'))
+                layers.append(LeakyReLU(alpha=0.1, dtype=policy, name=f'leaky_{block_index}'))
         elif name == 'detection':
-            s = section['side']
-            b = section['num']
-            c = section['classes']
+            s = int(section['side'])
+            b = int(section['num'])
+            c = int(section['classes'])
 
-            model.add(YOLODetection(s, b, c, name=f'detection_{block_index}'))
+            layers.append(YOLODetection(s, b, c, dtype='float32', name=f'detection_{block_index}'))
         
         block_index += 1
-    
+
+    # create the model, checking the shape of the input once at the model's boundary
+    x = tf.ensure_shape(x, (None,) + input_shape)
+    for layer in layers:
+        x = layer(x)
+    model = tf.keras.Model(inputs, x)
+
     return model
 
+def get_predict_function(model):
+    """
+    Returns a function that runs the model for inference on a batch of images.
+
+    The function is traced once for any batch size and compiled with XLA, which
+    fuses the elementwise ops (bias, batch norm, activations) of the network into
+    fewer kernels.
+    """
+
+    def predict(x):
+        return model(x, training=False)
+
+    input_signature = [tf.TensorSpec(model.input_shape, model.input.dtype)]
+    try:
+        return tf.function(predict, input_signature=input_signature, jit_compile=True)
+    except TypeError:
+        # TensorFlow < 2.5 calls the argument experimental_compile
+        return tf.function(predict, input_signature=input_signature, experimental_compile=True)
+
+def get_optimizer_for_dtype(optimizer, dtype='float32'):
+    """
+    Returns the optimizer to compile a model created with the given dtype policy with.
+
+    The layers of a 'mixed_float16' model have their own policy while the model keeps
+    the global one, so Model.compile() doesn't add loss scaling by itself. In that case
+    the optimizer is wrapped in a LossScaleOptimizer with a dynamic loss scale,
+    otherwise it's returned as is.
+    """
+
+    if Policy(dtype).compute_dtype == 'float16':
+        if EXPERIMENTAL_MIXED_PRECISION:
+            optimizer = LossScaleOptimizer(optimizer, loss_scale='dynamic')
+        else:
+            # the loss scale is dynamic by default
+            optimizer = LossScaleOptimizer(optimizer)
+    return optimizer
+
 def yolo_loss(y_true, y_pred, s=7, b=3, c=20, image_shape=IMAGE_SHAPE[:2], sqrt=True,
               object_scale=1, noobject_scale=.5, class_scale=1, coord_scale=5):
     """
@@ -272,14 +514,28 @@ def yolo_loss(y_true, y_pred, s=7, b=3, c=20, image_shape=IMAGE_SHAPE[:2], sqrt=
 
     return loss
 
-def load_pretrained_darknet(cfg_file, weights_file):
+def load_pretrained_darknet(cfg_file, weights_file, data_format='channels_last', dtype='float32', npz_file=None):
     """
     Loads a pretrained darknet model from a cfg file and a weights file
+
+    data_format and dtype are passed to create_model_from_cfg()
+
+    If npz_file is given and exists (see export_darknet_to_npz()), the weights are
+    loaded from it, already in the Keras layout, instead of from the weights file.
     """
 
     # create the model
     cfg = parse_cfg(cfg_file)
-    model = create_model_from_cfg(cfg)
+    model = create_model_from_cfg(cfg, data_format=data_format, dtype=dtype)
+    channel_axis = 1 if data_format == 'channels_first' else -1
+
+    # load the model weights from the exported keras weights
+    if npz_file is not None and os.path.exists(npz_file):
+        with np.load(npz_file) as npz_weights:
+            for layer in model.layers:
+                if layer.weights:
+                    layer.set_weights([npz_weights[f'{layer.name}/{i}'] for i in range(len(layer.weights))])
+        return model
 
     # load the model weights
     with open(weights_file, 'rb') as wf:
@@ -292,14 +548,21 @@ def load_pretrained_darknet(cfg_file, weights_file):
         else:
             seen_dtype = np.int32
         seen = np.fromfile(wf, dtype=seen_dtype, count=1)
+
+        # map the weights into memory instead of reading them, the layer weights are views
+        # into this array so only the pages of the layer being loaded need to be in memory
+        weights_blob = np.memmap(weights_file, dtype=np.float32, mode='r', offset=wf.tell())
+        offset = 0
     
         def load_array(shape):
             """
             Loads float32 arrays of the specified shape from the weights file
             """
 
-            weights = np.fromfile(wf, dtype=np.float32, count=np.prod(shape))
-            weights = weights.reshape(shape)
+            nonlocal offset
+            count = int(np.prod(shape))
+            weights = weights_blob[offset:offset+count].reshape(shape)
+            offset += count
             return weights
 
         # load the weights
@@ -312,7 +575,7 @@ def load_pretrained_darknet(cfg_file, weights_file):
                 # layer hyperparameters
                 f = conv2d_layer.filters
                 k_size = conv2d_layer.kernel_size[0]
-                c_in = conv2d_layer.input_shape[3]
+                c_in = conv2d_layer.input_shape[channel_axis]
                 use_bias = conv2d_layer.use_bias
                 try:
                     batch_normalize = section['batch_normalize'] == 1
@@ -355,25 +618,25 @@ def load_pretrained_darknet(cfg_file, weights_file):
                 local2d_layer = model.get_layer(f'local_{block_index}')
 
                 # layer hyperparameters
-                f = local2d_layer.filters
-                k_size = local2d_layer.kernel_size[0]
-                c_in = local2d_layer.input_shape[3]
-                _, h_out, w_out, _ = local2d_layer.output_shape
+                h_out, w_out, _, f = local2d_layer.kernel.shape
+                k_size = local2d_layer.kernel_size
+                c_in = local2d_layer.input_shape[channel_axis]
                 use_bias = local2d_layer.use_bias
 
-                # load conv2d biases
+                # load local2d biases
+                # darknet locally connected layer biases have the shape (f, h_out, w_out)
                 if use_bias:
-                    local2d_bias_shape = local2d_layer.output_shape[1:]
-                    local2d_bias = load_array(local2d_bias_shape)
+                    local2d_bias = load_array((f, h_out, w_out))
+                    local2d_bias = np.transpose(local2d_bias, [1, 2, 0])
 
                 # load local2d kernel weights
-                # assumption: darknet locally connected layer kernel weights have the shape (c_in, f, k_size, k_size, h_out, w_out)
-                darknet_kernel_shape = (c_in, f, k_size, k_size, h_out, w_out)
+                # darknet locally connected layer kernel weights have the shape (h_out, w_out, f, c_in, k_size, k_size)
+                darknet_kernel_shape = (h_out, w_out, f, c_in, k_size, k_size)
                 darknet_kernel_weights = load_array(darknet_kernel_shape)
 
-                # keras locally connected layer kernel weights have the shape (h*w, c_in*size*size, f)
-                local2d_kernel_shape = (h_out*w_out, c_in*k_size*k_size, f)
-                local2d_kernel_weights = np.transpose(darknet_kernel_weights, [4, 5, 0, 2, 3, 1])
+                # LocalAsConv kernel weights have the shape (h_out, w_out, k_size*k_size*c_in, f)
+                local2d_kernel_shape = (h_out, w_out, k_size*k_size*c_in, f)
+                local2d_kernel_weights = np.transpose(darknet_kernel_weights, [0, 1, 4, 5, 3, 2])
                 local2d_kernel_weights = local2d_kernel_weights.reshape((local2d_kernel_shape))
 
                 # set the layer weights
@@ -410,6 +673,202 @@ def load_pretrained_darknet(cfg_file, weights_file):
 
     return model
 
+def export_darknet_to_npz(cfg_file, weights_file, npz_file):
+    """
+    Loads a pretrained darknet model and saves its weights, rearranged to the Keras
+    layout, to an .npz file that load_pretrained_darknet() can load from directly.
+    """
+
+    model = load_pretrained_darknet(cfg_file, weights_file)
+
+    npz_weights = {}
+    for layer in model.layers:
+        for i, weights in enumerate(layer.get_weights()):
+            npz_weights[f'{layer.name}/{i}'] = weights
+
+    np.savez(npz_file, **npz_weights)
+
+def leaky_relu(x):
+    """
+    Darknet's leaky activation (a leaky ReLU with alpha = 0.1) as an activation function
+    """
+
+    return tf.nn.leaky_relu(x, alpha=0.1)
+
+def get_chain_layers(model):
+    """
+    Returns the layers of a model whose layers form a single chain (each layer's only
+    input is the output of the previous layer) in order, as (layer, call_kwargs)
+    pairs where call_kwargs are the keyword arguments the layer is called with.
+    The input layer is not included.
+
+    Raises a ValueError if the model's layers don't form a chain.
+    """
+
+    if isinstance(model, tf.keras.Sequential):
+        return [(layer, {}) for layer in model.layers]
+
+    chain_layers = []
+    previous_name = None
+
+    for layer_config in model.get_config()['layers']:
+        layer = model.get_layer(layer_config['name'])
+        if isinstance(layer, InputLayer):
+            if previous_name is not None:
+                raise ValueError(f'{model.name} has more than one input')
+            previous_name = layer.name
+            continue
+
+        # a node is a list of [layer name, node index, tensor index, kwargs] inputs, or a
+        # single input for layers wrapping TensorFlow ops
+        nodes = layer_config['inbound_nodes']
+        inputs = nodes[0] if len(nodes) == 1 else []
+        if len(inputs) > 0 and isinstance(inputs[0], str):
+            inputs = [inputs]
+
+        if len(inputs) != 1 or inputs[0][0] != previous_name:
+            raise ValueError(f'The layers of {model.name} do not form a chain at layer {layer.name}')
+
+        chain_layers.append((layer, inputs[0][3]))
+        previous_name = layer.name
+
+    return chain_layers
+
+def fold_batchnorm(model):
+    """
+    Returns a model for inference that is equivalent to the given model except that
+    each batch normalization layer that directly follows a Conv2D layer (without an
+    activation, and normalizing the channels axis) is folded into that layer's
+    kernel and bias:
+
+    kernel' = kernel * gamma / sqrt(variance + epsilon)
+    bias' = (bias - mean) * gamma / sqrt(variance + epsilon) + beta
+
+    A darknet leaky activation that follows the Conv2D (and batch norm) layer is
+    also moved into the Conv2D layer's activation so that TensorFlow can run the
+    convolution, bias and activation as a single fused op.
+
+    Only models whose layers form a single chain are supported (see get_chain_layers()),
+    such as the models created by create_model_from_cfg().
+
+    The folded Conv2D layers keep their names, the other layers are shared with the
+    given model. Loading a saved folded model requires custom_objects={'leaky_relu': leaky_relu}.
+    """
+
+    layers = get_chain_layers(model)
+
+    inputs = tf.keras.Input(shape=model.input_shape[1:], dtype=model.input.dtype, name='input_0')
+    x = inputs
+
+    i = 0
+    while i < len(layers):
+        layer, call_kwargs = layers[i]
+        if not isinstance(layer, Conv2D):
+            x = layer(x, **call_kwargs)
+            i += 1
+            continue
+
+        conv2d_weights = layer.get_weights()
+        kernel = conv2d_weights[0]
+        bias = conv2d_weights[1] if layer.use_bias else np.zeros(layer.filters, dtype=kernel.dtype)
+        config = layer.get_config()
+        is_linear = config['activation'] == 'linear'
+        channel_axis = 1 if layer.data_format == 'channels_first' else 3
+        j = i + 1
+
+        # fold the batch norm layer
+        bn_layer = layers[j][0] if j < len(layers) else None
+        if (is_linear and isinstance(bn_layer, BatchNormalization)
+                and [axis % 4 for axis in np.atleast_1d(bn_layer.axis)] == [channel_axis]):
+            mean = K.get_value(bn_layer.moving_mean)
+            variance = K.get_value(bn_layer.moving_variance)
+            gamma = K.get_value(bn_layer.gamma) if bn_layer.scale else np.ones_like(mean)
+            beta = K.get_value(bn_layer.beta) if bn_layer.center else np.zeros_like(mean)
+            scale = gamma / np.sqrt(variance + bn_layer.epsilon)
+
+            # the conv2d kernel has the shape (k_size, k_size, c_in, f) so the scale is broadcast over f
+            kernel = kernel * scale
+            bias = (bias - mean) * scale + beta
+            j += 1
+
+        # fold the activation
+        activation_layer = layers[j][0] if j < len(layers) else None
+        if is_linear and isinstance(activation_layer, LeakyReLU) and np.isclose(activation_layer.alpha, 0.1):
+            config['activation'] = leaky_relu
+            j += 1
+
+        if j == i + 1:
+            # nothing to fold
+            x = layer(x, **call_kwargs)
+        else:
+            # create a conv2d layer with the same configuration and a bias
+            config['use_bias'] = True
+            folded_layer = Conv2D.from_config(config)
+            x = folded_layer(x)
+            folded_layer.set_weights([kernel, bias])
+
+        i = j
+
+    return tf.keras.Model(inputs, x, name=model.name)
+
+def quantize_model(model, calibration_images):
+    """
+    Converts a model to a TensorFlow Lite model with int8 weights and activations
+    using full integer post-training quantization.
+
+    - calibration_images is an iterable of preprocessed images (see
+      data_processing.preprocess_image()) used to calibrate the ranges of the
+      activations, a few hundred images from the training set are usually enough
+
+    Returns the serialized TensorFlow Lite model. Its input and output are int8
+    tensors, the scale and zero point to convert them are in the interpreter's
+    input and output details.
+    """
+
+    def representative_dataset():
+        for image in calibration_images:
+            yield [np.asarray(image, dtype=np.float32)[None]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+
+    return converter.convert()
+
+def run_quantized_model(tflite_model, images):
+    """
+    Runs a model returned by quantize_model() on a batch of preprocessed images with
+    the TensorFlow Lite interpreter.
+
+    The images are quantized to int8 and the int8 outputs are converted back to
+    float32 with the scale and zero point of the model's input and output, so the
+    outputs can be compared with the Keras model's.
+
+    LocalAsConv layers run as int8 BATCH_MATMUL ops, so the whole model runs in int8.
+    """
+
+    interpreter = tf.lite.Interpreter(model_content=tflite_model)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+
+    input_scale, input_zero_point = input_details['quantization']
+    output_scale, output_zero_point = output_details['quantization']
+
+    outputs = []
+    for image in images:
+        x = np.round(np.asarray(image, dtype=np.float32) / input_scale + input_zero_point)
+        interpreter.set_tensor(input_details['index'], np.clip(x, -128, 127).astype(np.int8)[None])
+        interpreter.invoke()
+
+        y = interpreter.get_tensor(output_details['index']).astype(np.float32)
+        outputs.append((y[0] - output_zero_point) * output_scale)
+
+    return np.stack(outputs)
+
 if __name__ == "__main__":
     import zipfile
     from io_utils import *